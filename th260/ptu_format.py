@@ -24,7 +24,69 @@ def tab_string(bstring, length):
     """
     Write a binary string to the specified length, appending zeros as needed.
     """
-    return bstring + bytes(length - len(bstring))
+    return bstring.ljust(length, b'\x00')
+
+
+def _write_empty(value):
+    """Write an empty tag value."""
+    return bytes(thdef.BITSLEN_TAG_VALUE)
+
+
+# Precompiled packers for integer or boolean, and float tag values
+_write_int = struct.Struct("<q").pack
+_write_float = struct.Struct("<d").pack
+
+
+def _write_raw(value):
+    """Write a tag value that is already encoded."""
+    return value
+
+
+def _write_array(value, null_terminated=False):
+    """Write the length of an array followed by the padded array."""
+    length = len(value)
+    if null_terminated:
+        length += 1
+    # Round to ceil 8
+    length += (8 - length % 8) % 8
+    return (length.to_bytes(
+        thdef.BITSLEN_TAG_VALUE, byteorder='little', signed=False)
+        + tab_string(value, length))
+
+
+def _write_float_array(value):
+    """Write a float array tag value."""
+    return _write_array(np.ascontiguousarray(value, dtype='<f8').tobytes())
+
+
+def _write_string(value):
+    """Write a null-terminated string tag value."""
+    return _write_array(value.encode('UTF8'), null_terminated=True)
+
+
+_WRITERS = {
+    'Empty8': _write_empty,
+    'Bool8': _write_int,
+    'Int8': _write_int,
+    'BitSet64': _write_raw,
+    'Color8': _write_raw,
+    'Float8': _write_float,
+    'TDateTime': _write_raw,
+    'Float8Array': _write_float_array,
+    'ASCII-String': _write_string,
+    'Wide-String': _write_string,
+    'BinaryBlob': _write_array,
+    }
+
+# Encoded type code and value writer for each tag id
+_TAG_DISPATCH = {
+    tag_id: (
+        thdef.type_code[dtype].to_bytes(
+            thdef.BITSLEN_TAG_TYPECODE, byteorder='little'),
+        _WRITERS[dtype])
+    for tag_id, dtype in thdef.tag_types.items()}
+
+_NO_TAG_IDX = bytes([0xff] * thdef.BITSLEN_TAG_IDX)
 
 
 def write_tag(key, value):
@@ -36,7 +98,7 @@ def write_tag(key, value):
     else:
         tag_id = key
         tag_idx = None
-    dtype = thdef.tag_types[tag_id]
+    type_code, writer = _TAG_DISPATCH[tag_id]
 
     header = tab_string(tag_id.encode(), thdef.BITSLEN_TAG_ID)
 
@@ -44,76 +106,36 @@ def write_tag(key, value):
     if tag_idx is not None:
         header += tag_idx.to_bytes(thdef.BITSLEN_TAG_IDX, byteorder='little')
     else:
-        header += bytes([0xff] * thdef.BITSLEN_TAG_IDX)
-
-    # Type Code
-    header += thdef.type_code[dtype].to_bytes(
-        thdef.BITSLEN_TAG_TYPECODE, byteorder='little')
-
-    # Data
-    is_array = dtype in [
-        'Float8Array',
-        'ASCII-String',
-        'Wide-String',
-        'BinaryBlob']
-
-    is_string = dtype in [
-        'ASCII-String',
-        'Wide-String']
-
-    if dtype == 'Empty8':
-        header += bytes(thdef.BITSLEN_TAG_VALUE)
-    elif dtype in ['Bool8', 'Int8']:
-        header += value.to_bytes(
-            thdef.BITSLEN_TAG_VALUE, byteorder='little', signed=True)
-    elif dtype == 'Float8':
-        header += struct.pack("<d", value)
-    elif dtype in ['BitSet64', 'Color8', 'TDateTime']:
-        header += value
-    elif is_array:
-        # Prepare value
-        if is_string:
-            value = value.encode('UTF8')
-        elif dtype == 'Float8Array':
-            out = b''
-            for val in value:
-                out += struct.pack("<d", val)
-            value = out
-        # Get length
-        length = len(value)
-        if is_string:
-            # null-terminated
-            length += 1
-        # Round to ceil 8
-        length += (8 - length % 8) % 8
-        header += length.to_bytes(
-            thdef.BITSLEN_TAG_VALUE, byteorder='little', signed=False)
-
-        header += tab_string(value, length)
+        header += _NO_TAG_IDX
 
-    else:
-        raise RuntimeError(f"No such dtype {dtype}")
-
-    return header
+    # Type Code and Data
+    return header + type_code + writer(value)
 
 
 def write_ptu(outputfilename, data, tags):
     """
     Save the data in a ptu file
+
+    data is a uint32 array of records, written without copy when it is
+    already contiguous and little-endian, or any object supporting the
+    buffer protocol, written as is.
     """
+    if isinstance(data, np.ndarray):
+        if data.dtype.kind != 'u' or data.dtype.itemsize != 4:
+            raise TypeError(f"Records must be uint32, not {data.dtype}.")
+        data = np.ascontiguousarray(data, dtype='<u4')
 
-    header = tab_string(thdef.TTTR_MAGIC.encode(), thdef.BITSLEN_MAGIC)
-    header += tab_string(
-        thdef.FILE_VERSION.encode(), thdef.BITSLEN_VERSION)
+    parts = [
+        tab_string(thdef.TTTR_MAGIC.encode(), thdef.BITSLEN_MAGIC),
+        tab_string(thdef.FILE_VERSION.encode(), thdef.BITSLEN_VERSION)]
 
-    for key in tags:
-        header += write_tag(key, tags[key])
+    parts.extend(write_tag(key, value) for key, value in tags.items())
 
-    header += write_tag('Header_End', None)
+    parts.append(write_tag('Header_End', None))
     # Write file
     with open(outputfilename, "wb+") as outputfile:
-        outputfile.write(header)
-        outputfile.write(data)
+        outputfile.write(b"".join(parts))
+        outputfile.write(memoryview(data).cast('B'))
 
 
 def read_T2_record(record):
@@ -135,10 +157,9 @@ def read_T2_record(record):
      - codes from 1 to 15 identify markers, the individual bits are
        external markers.
     """
-    recordData = "{0:032b}".format(record)
-    special = int(recordData[0:1], base=2)
-    channel = int(recordData[1:7], base=2)
-    timetag = int(recordData[7:32], base=2)
+    special = (record >> 31) & 0x1
+    channel = (record >> 25) & 0x3F
+    timetag = record & 0x01FFFFFF
     if special == 1:
         if channel == 0x3F:  # Overflow
             return 'overflow', 0, timetag
@@ -171,11 +192,10 @@ def read_T3_record(record):
      - codes from 1 to 15 identify markers, the individual bits are
        external markers.
     '''
-    recordData = "{0:032b}".format(record)
-    special = int(recordData[0:1], base=2)
-    channel = int(recordData[1:7], base=2)
-    dtime = int(recordData[7:22], base=2)
-    nsync = int(recordData[22:32], base=2)
+    special = (record >> 31) & 0x1
+    channel = (record >> 25) & 0x3F
+    dtime = (record >> 10) & 0x7FFF
+    nsync = record & 0x3FF
 
     if special == 1:
         if channel == 0x3F:  # Overflow
@@ -188,7 +208,99 @@ def read_T3_record(record):
         return 'photon', channel + 1, dtime, nsync
 
 
-def read_T2_buffer(buffer, channel=1, rtype='photon'):
+# Record kinds returned by read_T2_records
+RECORD_INVALID = -1
+RECORD_PHOTON = 0
+RECORD_OVERFLOW = 1
+RECORD_MARKER = 2
+RECORD_SYNC = 3
+
+
+def _T2_lookup_tables():
+    """
+    Kind and channel of a T2 record, indexed by its 7 header bits.
+    """
+    kinds = np.full(0x80, RECORD_INVALID, dtype=np.int8)
+    channels = np.zeros(0x80, dtype=np.uint8)
+    # Regular input channels
+    kinds[:0x40] = RECORD_PHOTON
+    channels[:0x40] = np.arange(1, 0x41)
+    # Special records
+    kinds[0x40] = RECORD_SYNC
+    kinds[0x41:0x50] = RECORD_MARKER
+    channels[0x41:0x50] = np.arange(1, 0x10)
+    kinds[0x7F] = RECORD_OVERFLOW
+    return kinds, channels
+
+
+_T2_KINDS, _T2_CHANNELS = _T2_lookup_tables()
+
+
+def read_T2_records(buffer):
+    """
+    Read every event of a T2 buffer.
+
+    Equivalent to calling read_T2_record on each record, but returns arrays:
+        kinds: RECORD_PHOTON, RECORD_OVERFLOW, RECORD_MARKER or RECORD_SYNC
+        channels: channel as returned by read_T2_record
+        timetags: timetag, or number of overflows for overflow records
+    """
+    buffer = np.asarray(buffer, dtype=np.uint32)
+    header = buffer >> 25
+    kinds = _T2_KINDS[header]
+    if np.any(kinds == RECORD_INVALID):
+        raise RuntimeError("Invalid record.")
+    channels = _T2_CHANNELS[header]
+    timetags = buffer & 0x01FFFFFF
+    return kinds, channels, timetags
+
+
+def _count_overflows(idx_overflows, counts, idx_data, initial_overflow=0):
+    """
+    Number of overflows preceding each selected record.
+
+    idx_overflows and idx_data are the positions of the overflow and
+    selected records, counts the number of overflows of each overflow record.
+    Only these records are touched, which avoids building a cumulative sum
+    over the full buffer. The count starts at initial_overflow.
+    """
+    # Number of overflows after each overflow record, starting with none
+    # int64, like the tables the times are written to
+    cumsum_overflows = np.empty(len(counts) + 1, dtype=np.int64)
+    cumsum_overflows[0] = 0
+    np.cumsum(counts, dtype=np.int64, out=cumsum_overflows[1:])
+    cumsum_overflows += initial_overflow
+
+    # Number of overflow records before each data record
+    position = np.searchsorted(idx_overflows, idx_data)
+    n_overflows = cumsum_overflows[position]
+    total_overflows = cumsum_overflows[-1]
+    return n_overflows, total_overflows
+
+
+def _select_records(buffer, bit_selected, bit_overflow):
+    """
+    Positions of the overflow records and of the selected records.
+
+    The records are classified in a single pass with a lookup table indexed
+    by the 7 header bits (special and channel). The buffer is then scanned
+    once for both kinds of records and only the matches are split.
+    """
+    lut = np.zeros(0x80, dtype=np.int8)
+    lut[bit_selected >> 25] = 1
+    lut[bit_overflow >> 25] = 2
+    if buffer.dtype == np.dtype('<u4') and buffer.flags.c_contiguous:
+        # The header is in the most significant byte, only read that byte.
+        # Its lowest bit belongs to the timetag, so each entry is doubled.
+        classes = np.repeat(lut, 2)[buffer.view(np.uint8)[3::4]]
+    else:
+        classes = lut[buffer >> 25]
+    idx_matches = np.flatnonzero(classes)
+    mask_overflows = classes[idx_matches] == 2
+    return idx_matches[mask_overflows], idx_matches[~mask_overflows]
+
+
+def read_T2_buffer(buffer, channel=1, rtype='photon', initial_overflow=0):
     """
     Read T2 buffer
 
@@ -206,45 +318,42 @@ def read_T2_buffer(buffer, channel=1, rtype='photon'):
      - code 0 (all bits zeroes) identifies a sync event,
      - codes from 1 to 15 identify markers, the individual bits are
        external markers.
+
+    The overflow counts start at initial_overflow, so the total returned for
+    a buffer can be passed when reading the next one.
     """
-    # 10000000000000000000000000000000
-    bitmask_special = 0x80000000
-    # 01111110000000000000000000000000
-    bitmask_channel = 0x7e000000
-    # 11111110000000000000000000000000
-    bitmask_header = bitmask_special | bitmask_channel
     # 00000001111111111111111111111111
     bitmask_timetag = 0x01ffffff
 
     # 11111110000000000000000000000000
-    bit_overflow = 0xfe000000
+    bit_overflow = np.uint32(0xfe000000)
 
     if rtype == 'photon':
         # -1 becauses reasons?
-        bit_selected = (channel - 1) << 25
+        bit_selected = np.uint32((channel - 1) << 25)
     elif rtype == 'marker':
-        bit_selected = 0x80000000 + channel << 25
+        bit_selected = np.uint32(0x80000000 | (channel << 25))
     elif rtype == 'sync':
-        bit_selected = 0x80000000
+        bit_selected = np.uint32(0x80000000)
     else:
         raise RuntimeError(f'Unknown type {rtype}')
 
-    header = buffer & bitmask_header
+    # Only extract the fields of the records we need
+    idx_overflows, idx_data = _select_records(
+        buffer, bit_selected, bit_overflow)
 
-    mask_overflows = header == bit_overflow
-    mask_data = header == bit_selected
-
-    timetags = buffer & bitmask_timetag
-    overflows_counts = np.cumsum(timetags * mask_overflows, dtype='uint32')
-
-    n_overflows = overflows_counts[mask_data]
-    timetag = timetags[mask_data]
-    total_overflows = overflows_counts[-1]
+    # Indexing copies the records, so the fields are extracted in place
+    counts = buffer[idx_overflows]
+    counts &= bitmask_timetag
+    n_overflows, total_overflows = _count_overflows(
+        idx_overflows, counts, idx_data, initial_overflow)
+    timetag = buffer[idx_data]
+    timetag &= bitmask_timetag
 
     return n_overflows, timetag, total_overflows
 
 
-def read_T3_buffer(buffer, channel=1, rtype='photon'):
+def read_T3_buffer(buffer, channel=1, rtype='photon', initial_overflow=0):
     '''
     Read T3 buffer
 
@@ -262,35 +371,35 @@ def read_T3_buffer(buffer, channel=1, rtype='photon'):
        overflows can be read from nsync value.
      - codes from 1 to 15 identify markers, the individual bits are
        external markers.
+
+    The overflow counts start at initial_overflow, so the total returned for
+    a buffer can be passed when reading the next one.
     '''
-    bitmask_special = 0x80000000
-    bitmask_channel = 0x7e000000
-    bitmask_header = bitmask_special | bitmask_channel
     bitmask_dtime = 0x01fffc00
     bitmask_nsync = 0x000003ff
 
-    bit_overflow = 0xfe000000
+    bit_overflow = np.uint32(0xfe000000)
 
     if rtype == 'photon':
         # -1 becauses reasons?
-        bit_selected = (channel - 1) << 25
+        bit_selected = np.uint32((channel - 1) << 25)
     elif rtype == 'marker':
-        bit_selected = 0x80000000 + channel << 25
+        bit_selected = np.uint32(0x80000000 | (channel << 25))
     else:
         raise RuntimeError(f'Unknown type {rtype}')
 
-    header = buffer & bitmask_header
-
-    mask_overflows = header == bit_overflow
-    mask_data = header == bit_selected
-
-    dtime = (buffer & bitmask_dtime) >> 10
-    nsync = buffer & bitmask_nsync
-    overflows_counts = np.cumsum(nsync * mask_overflows, dtype='uint32')
-
-    n_overflows = overflows_counts[mask_data]
-    dtime = dtime[mask_data]
-    nsync = nsync[mask_data]
-    total_overflows = overflows_counts[-1]
+    # Only extract the fields of the records we need
+    idx_overflows, idx_data = _select_records(
+        buffer, bit_selected, bit_overflow)
+
+    # Indexing copies the records, so the fields are extracted in place
+    counts = buffer[idx_overflows]
+    counts &= bitmask_nsync
+    n_overflows, total_overflows = _count_overflows(
+        idx_overflows, counts, idx_data, initial_overflow)
+    nsync = buffer[idx_data]
+    dtime = nsync & bitmask_dtime
+    dtime >>= 10
+    nsync &= bitmask_nsync
 
     return n_overflows, dtime, nsync, total_overflows
@@ -10,21 +10,41 @@ Created on Jul 2019
 @author: Quentin Peter
 """
 
+import os
 import time
+import copy
 import ctypes as ct
 from ctypes import byref
 import warnings
 import uuid
 import numpy as np
 import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
 from th260 import th260definitions as thdef
-from th260.tttr_result import T2Result
+from th260.tttr_result import T2Result, ExtendableTable
 from th260.ptu_format import write_ptu
 
 
 dll_file = "th260lib64.dll"
 
+# Number of FIFO buffers, so the FIFO can be read while records are stored.
+# At least 3: one read, one stored and one waiting.
+fifo_ring_size = 3
+
+# Minimum number of new records processed by get_records during a measurment
+records_batch_size = 0x10000
+
+# Maximum time get_records waits for a full batch, in s
+records_batch_delay = 0.1
+
+# Minimum time between two reads of the flags and acquisition time, in s
+status_poll_interval = 0.005
+
+# Maximum number of threads reading the records of different channels
+records_threads = os.cpu_count() or 1
+
 default_settings = dict(
     mode=2,
     binning=0,  # you can change this, meaningful only in T3 mode
@@ -48,19 +68,59 @@ default_settings = dict(
 # =============================================================================
 # General Functions
 # =============================================================================
+c_int_p = ct.POINTER(ct.c_int)
+c_uint_p = ct.POINTER(ct.c_uint)
+c_double_p = ct.POINTER(ct.c_double)
+
+# Argument types of the dll functions, all of them return an error code
+dll_functions = {
+    'TH260_GetErrorString': [ct.c_char_p, ct.c_int],
+    'TH260_GetLibraryVersion': [ct.c_char_p],
+    'TH260_OpenDevice': [ct.c_int, ct.c_char_p],
+    'TH260_CloseDevice': [ct.c_int],
+    'TH260_Initialize': [ct.c_int, ct.c_int],
+    'TH260_GetHardwareInfo': [
+        ct.c_int, ct.c_char_p, ct.c_char_p, ct.c_char_p],
+    'TH260_GetNumOfInputChannels': [ct.c_int, c_int_p],
+    'TH260_SetSyncDiv': [ct.c_int, ct.c_int],
+    'TH260_SetSyncCFD': [ct.c_int, ct.c_int, ct.c_int],
+    'TH260_SetInputCFD': [ct.c_int, ct.c_int, ct.c_int, ct.c_int],
+    'TH260_SetSyncEdgeTrg': [ct.c_int, ct.c_int, ct.c_int],
+    'TH260_SetInputEdgeTrg': [ct.c_int, ct.c_int, ct.c_int, ct.c_int],
+    'TH260_SetSyncChannelOffset': [ct.c_int, ct.c_int],
+    'TH260_SetInputChannelOffset': [ct.c_int, ct.c_int, ct.c_int],
+    'TH260_SetBinning': [ct.c_int, ct.c_int],
+    'TH260_SetOffset': [ct.c_int, ct.c_int],
+    'TH260_GetResolution': [ct.c_int, c_double_p],
+    'TH260_GetBaseResolution': [ct.c_int, c_double_p, c_int_p],
+    'TH260_GetSyncRate': [ct.c_int, c_int_p],
+    'TH260_GetCountRate': [ct.c_int, ct.c_int, c_int_p],
+    'TH260_GetWarnings': [ct.c_int, c_int_p],
+    'TH260_GetWarningsText': [ct.c_int, ct.c_char_p, ct.c_int],
+    'TH260_GetFlags': [ct.c_int, c_int_p],
+    'TH260_ReadFiFo': [ct.c_int, c_uint_p, ct.c_int, c_int_p],
+    'TH260_CTCStatus': [ct.c_int, c_int_p],
+    'TH260_StartMeas': [ct.c_int, ct.c_int],
+    'TH260_StopMeas': [ct.c_int],
+}
+
+
 class TH260lib():
     """
-    Wrap dll to add a threading lock.
+    Wrap dll and hold the lock for functions not tied to a device.
     """
 
     def __init__(self):
         # Open DLL
         self._dll = ct.CDLL(dll_file)
         self.lock = threading.RLock()
-
-    def __getattr__(self, name):
-        with self.lock:
-            return getattr(self._dll, name)
+        # Bind the functions once so calls don't go through the dll lookup.
+        # Declaring the types lets ctypes convert python ints directly.
+        for name, argtypes in dll_functions.items():
+            function = getattr(self._dll, name)
+            function.argtypes = argtypes
+            function.restype = ct.c_int
+            setattr(self, name, function)
 
 
 th260lib = TH260lib()
@@ -68,17 +128,18 @@ th260lib = TH260lib()
 
 def dlllock(func):
     """
-    Decorator for functions.
+    Decorator for methods, serializes the calls with the device lock.
 
-    This is needed because it looks like the dll is not thread safe.
+    This is needed because it looks like the dll is not thread safe for a
+    given device. Each device has its own lock so that several devices can
+    be used in parallel.
     """
-    def wrapper(*args, **kwargs):
-        with th260lib.lock:
-            return func(*args, **kwargs)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
     return wrapper
 
 
-@dlllock
 def getErrorString(retcode):
     """
     TH260_GetErrorString
@@ -88,11 +149,11 @@ def getErrorString(retcode):
     handling message boxes, support enquiries etc.
     """
     errorString = ct.create_string_buffer(b"", thdef.MAXSTRLEN_ERRSTR)
-    th260lib.TH260_GetErrorString(errorString, ct.c_int(retcode))
+    with th260lib.lock:
+        th260lib.TH260_GetErrorString(errorString, retcode)
     return errorString.value.decode("utf-8")
 
 
-@dlllock
 def getLibraryVersion():
     """
     TH260_GetLibraryVersion
@@ -101,7 +162,8 @@ def getLibraryVersion():
     your own application.
     """
     libVersion = ct.create_string_buffer(b"", thdef.MAXSTRLEN_LIBVER)
-    th260lib.TH260_GetLibraryVersion(libVersion)
+    with th260lib.lock:
+        th260lib.TH260_GetLibraryVersion(libVersion)
     return libVersion.value.decode("utf-8")
 
 
@@ -130,6 +192,16 @@ def tryfunc(retcode):
         raise TH260Error(retcode, getErrorString(retcode))
 
 
+def aligned_empty(size, dtype, alignment=4096):
+    """
+    Get an empty array whose data is aligned on alignment bytes.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    raw = np.empty(size * itemsize + alignment, dtype=np.uint8)
+    offset = -raw.ctypes.data % alignment
+    return raw[offset:offset + size * itemsize].view(dtype)
+
+
 def get_avilable_devices():
     """
     Get a list of avilable devices.
@@ -156,8 +228,28 @@ class TH260_API():
         """
         Open the devices. Specify serial number or device number.
         """
-        self._device_number = ct.c_int(device_number)
+        self._device_number = device_number
+        self.lock = threading.RLock()
+        # Reused by the rate getters, which can be polled at high frequency.
+        # They stay locked as they share these.
+        self._rate = ct.c_int()
+        self._rate_ref = byref(self._rate)
+        # Reused by the acquisition loop
+        self._flags = ct.c_int()
+        self._flags_ref = byref(self._flags)
+        self._nrecords = ct.c_int()
+        self._nrecords_ref = byref(self._nrecords)
+        self._ctcstatus = ct.c_int()
+        self._ctcstatus_ref = byref(self._ctcstatus)
+        self._last_status_poll = None
+        # Buffers for readFiFo, allocated once and aligned for DMA transfers
+        self._fifo_ring = [aligned_empty(thdef.TTREADMAX, np.uint32)
+                           for i in range(fifo_ring_size)]
+        self._fifo_pointers = [buffer.ctypes.data_as(c_uint_p)
+                               for buffer in self._fifo_ring]
+        self._fifo_index = 0
 
+    @dlllock
     def closeDevice(self):
         """
         TH260_CloseDevice
@@ -189,13 +281,12 @@ class TH260_API():
         measurement modes.
         """
         tryfunc(th260lib.TH260_Initialize(
-            self._device_number, ct.c_int(mode)))
+            self._device_number, mode))
 
     # =========================================================================
     # Methods for Use on Initialized Devices
     # =========================================================================
 
-    @dlllock
     def getHardwareInfo(self):
         """
         TH260_GetHardwareInfo
@@ -209,7 +300,6 @@ class TH260_API():
                 "Partno": hwPartno.value.decode("utf-8"),
                 "Version": hwVersion.value.decode("utf-8")}
 
-    @dlllock
     def getNumOfInputChannels(self):
         """
         TH260_GetNumOfInputChannels
@@ -224,6 +314,7 @@ class TH260_API():
             self._device_number, byref(numChannels)))
         return numChannels.value
 
+    @dlllock
     def setSyncDiv(self, syncDivider):
         """
         TH260_SetSyncDiv
@@ -234,21 +325,22 @@ class TH260_API():
         divider setting and deliver the ex- ternal (undivided) rate. When the
         sync input is used for a detector signal the divider should be set to
         1.
+
+        Allow thdef.INIT_WAIT_TIME for valid count rate readings, this is
+        left to the caller so the lock is not held during the wait.
         """
         tryfunc(th260lib.TH260_SetSyncDiv(
-            self._device_number, ct.c_int(syncDivider)))
-        # Note: after Init or SetSyncDiv allow 150 ms
-        # for valid count rate readings
-        time.sleep(thdef.INIT_WAIT_TIME)
+            self._device_number, syncDivider))
 
+    @dlllock
     def setSyncCFD(self, syncCFDLevel, syncCFDZeroCross):
         """
         TH260_SetSyncCFD
         """
         tryfunc(th260lib.TH260_SetSyncCFD(
-            self._device_number, ct.c_int(syncCFDLevel),
-            ct.c_int(syncCFDZeroCross)))
+            self._device_number, syncCFDLevel, syncCFDZeroCross))
 
+    @dlllock
     def setInputCFD(self, channel, inputCFDLevel, inputCFDZeroCross):
         """
         TH260_SetInputCFD
@@ -257,17 +349,17 @@ class TH260_API():
         through TH260_GetNumOfInputChannels().
         """
         tryfunc(th260lib.TH260_SetInputCFD(
-            self._device_number, ct.c_int(channel), ct.c_int(inputCFDLevel),
-            ct.c_int(inputCFDZeroCross)))
+            self._device_number, channel, inputCFDLevel, inputCFDZeroCross))
 
+    @dlllock
     def setSyncEdgeTrg(self, syncTriggerLevel, syncTriggerEdge):
         """
         TH260_SetSyncEdgeTrg
         """
         tryfunc(th260lib.TH260_SetSyncEdgeTrg(
-            self._device_number, ct.c_int(syncTriggerLevel),
-            ct.c_int(syncTriggerEdge)))
+            self._device_number, syncTriggerLevel, syncTriggerEdge))
 
+    @dlllock
     def setInputEdgeTrg(self, channel, inputTriggerLevel, inputTriggerEdge):
         """
         TH260_SetInputEdgeTrg
@@ -276,17 +368,18 @@ class TH260_API():
         through TH260_GetNumOfInputChannels().
         """
         tryfunc(th260lib.TH260_SetInputEdgeTrg(
-            self._device_number, ct.c_int(channel),
-            ct.c_int(inputTriggerLevel),
-            ct.c_int(inputTriggerEdge)))
+            self._device_number, channel, inputTriggerLevel,
+            inputTriggerEdge))
 
+    @dlllock
     def setSyncChannelOffset(self, offset):
         """
         TH260_SetSyncChannelOffset
         """
         tryfunc(th260lib.TH260_SetSyncChannelOffset(
-            self._device_number, ct.c_int(offset)))
+            self._device_number, offset))
 
+    @dlllock
     def setInputChannelOffset(self, channel, offset):
         """
         TH260_SetInputChannelOffset
@@ -295,8 +388,9 @@ class TH260_API():
         through TH260_GetNumOfInputChannels().
         """
         tryfunc(th260lib.TH260_SetInputChannelOffset(
-            self._device_number, ct.c_int(channel), ct.c_int(offset)))
+            self._device_number, channel, offset))
 
+    @dlllock
     def setBinning(self, binning):
         """
         TH260_SetBinning
@@ -309,8 +403,9 @@ class TH260_API():
             3 = 8x base resolution, and so on.
         """
         tryfunc(th260lib.TH260_SetBinning(
-                self._device_number, ct.c_int(binning)))
+                self._device_number, binning))
 
+    @dlllock
     def setOffset(self, offset):
         """
         TH260_SetOffset
@@ -322,9 +417,8 @@ class TH260_API():
         recorded. It is only meaningful in histogramming and T3 mode.
         """
         tryfunc(th260lib.TH260_SetOffset(
-                self._device_number, ct.c_int(offset)))
+                self._device_number, offset))
 
-    @dlllock
     def getResolution(self):
         """
         TH260_GetResolution
@@ -337,7 +431,6 @@ class TH260_API():
                 self._device_number, byref(resolution)))
         return resolution.value
 
-    @dlllock
     def getBaseResolution(self):
         """
         TH260_GetBaseResolution
@@ -362,10 +455,9 @@ class TH260_API():
         stable rate reading. Similarly, wait at least 100 ms to get a new
         reading. This is the gate time of the hardware counters.
         """
-        syncRate = ct.c_int()
         tryfunc(th260lib.TH260_GetSyncRate(
-            self._device_number, byref(syncRate)))
-        return syncRate.value
+            self._device_number, self._rate_ref))
+        return self._rate.value
 
     @dlllock
     def getCountRate(self, channel):
@@ -378,12 +470,10 @@ class TH260_API():
         correspond to nchannels-1 as obtained through
         TH260_GetNumOfInputChannels().
         """
-        countRate = ct.c_int()
         tryfunc(th260lib.TH260_GetCountRate(
-            self._device_number, ct.c_int(channel), byref(countRate)))
-        return countRate.value
+            self._device_number, channel, self._rate_ref))
+        return self._rate.value
 
-    @dlllock
     def getWarnings(self):
         """
         TH260_GetWarnings
@@ -396,7 +486,6 @@ class TH260_API():
             self._device_number, byref(warnings)))
         return warnings.value
 
-    @dlllock
     def getWarningsText(self, warnings):
         """
         TH260_GetWarningsText
@@ -404,9 +493,8 @@ class TH260_API():
         This helps to identify suspicious measurement conditions that may be
         due to inappropriate settings.
         """
-        warnings = ct.c_int(warnings)
         warningstext = ct.create_string_buffer(b"", thdef.MAXSTRLEN_WRNTXT)
-        if warnings.value != 0:
+        if warnings != 0:
             tryfunc(th260lib.TH260_GetWarningsText(
                 self._device_number, warningstext, warnings))
             return warningstext.value.decode("utf-8")
@@ -416,7 +504,6 @@ class TH260_API():
 #  Measurment
 # =============================================================================
 
-    @dlllock
     def readFiFo(self):
         """
         TH260_ReadFiFo
@@ -429,42 +516,67 @@ class TH260_API():
         boundary in order to allow efficient DMA transfers. If the buffer does
         not meet this requirement the library will use an internal buffer and
         copy the data. This slows down data throughput.
+
+        The returned array is a view on an internal buffer that is overwritten
+        after fifo_ring_size - 1 more non empty reads, copy it to keep the
+        data.
+
+        Not locked as it is on the acquisition hot path, only call it from
+        the acquisition thread.
         """
-        flags = ct.c_int()
-        tryfunc(th260lib.TH260_GetFlags(self._device_number, byref(flags)))
+        flags = self.pollStatus()[0]
 
-        if flags.value & thdef.FLAG_FIFOFULL > 0:
+        if flags & thdef.FLAG_FIFOFULL > 0:
             raise TH260Error(0, "FiFo Overrun!")
 
-        buffer = (ct.c_uint * thdef.TTREADMAX)()
-        nRecords = ct.c_int()
-        try:
-            tryfunc(th260lib.TH260_ReadFiFo(
-                self._device_number, byref(buffer), thdef.TTREADMAX,
-                byref(nRecords)))
-        except TH260Error:
-            raise
+        index = self._fifo_index
+        tryfunc(th260lib.TH260_ReadFiFo(
+            self._device_number, self._fifo_pointers[index],
+            thdef.TTREADMAX, self._nrecords_ref))
 
-        if nRecords.value > 0:
-            # Cut the buffer at the right size and wrap it in a numpy array
-            # so we can avoid working with ctypes objects
-            return np.array((ct.c_uint * nRecords.value).from_address(
-                        ct.addressof(buffer)))
-        return np.zeros(0, dtype=ct.c_uint)
+        # Only move to the next buffer of the ring if this one was filled,
+        # empty reads are not stored and don't free a buffer
+        if self._nrecords.value > 0:
+            self._fifo_index = (index + 1) % fifo_ring_size
+
+        # Cut the buffer at the right size, without copy
+        return self._fifo_ring[index][:self._nrecords.value]
 
-    @dlllock
     def CTCStatus(self):
         """
         TH260_CTCStatus
 
         This routine should be called to determine if the acuisition time
         has expired.
+
+        Not locked as it is on the acquisition hot path, only call it from
+        the acquisition thread.
         """
-        ctcstatus = ct.c_int()
         tryfunc(th260lib.TH260_CTCStatus(
-            self._device_number, byref(ctcstatus)))
-        return ctcstatus.value
+            self._device_number, self._ctcstatus_ref))
+        return self._ctcstatus.value
+
+    def pollStatus(self):
+        """
+        TH260_GetFlags and TH260_CTCStatus
+
+        Returns the flags and the CTC status. The device is queried at most
+        every status_poll_interval, the last values are returned otherwise.
+
+        Not locked as it is on the acquisition hot path, only call it from
+        the acquisition thread.
+        """
+        now = time.monotonic()
+        if (self._last_status_poll is None
+                or now - self._last_status_poll >= status_poll_interval):
+            self._last_status_poll = now
+            tryfunc(th260lib.TH260_GetFlags(
+                self._device_number, self._flags_ref))
+            tryfunc(th260lib.TH260_CTCStatus(
+                self._device_number, self._ctcstatus_ref))
+        return self._flags.value, self._ctcstatus.value
 
+    @dlllock
     def startMeas(self, tacq):
         """
         TH260_StartMeas
@@ -475,10 +587,13 @@ class TH260_API():
         called after all settings are done. Previous measurements should be
         stopped before calling this routine again.
         """
+        # Don't use the status of a previous measurment
+        self._last_status_poll = None
         # send start signal
         tryfunc(th260lib.TH260_StartMeas(
-            self._device_number, ct.c_int(tacq)))
+            self._device_number, tacq))
 
+    @dlllock
     def stopMeas(self):
         """
         TH260_StopMeas
@@ -500,11 +615,19 @@ class TH260():
         """
         self._keep_buffer = True
 
-        self.__running = False
+        # Set when no measurment is running
+        self._stop_event = threading.Event()
+        self._stop_event.set()
         self._measure_thread = None
+        # Exception raised while storing the buffers, for wait_end_measure
+        self._store_error = None
         self._acquisition_time = None
-        self._local_buffer = []
+        # Contiguous records read from the device
+        self._local_buffer = ExtendableTable(dtype='uint32')
+        self._local_buffer_lock = threading.Lock()
         self.records = None
+        # Reads the records of different channels, started when needed
+        self._records_executor = None
 
         self._serial = serial_number
         self._api = None
@@ -517,7 +640,25 @@ class TH260():
             raise RuntimeError(
                 f"Couldn't find serial number {serial_number}")
 
-        self._settings = default_settings
+        # Own copy, as the per-channel lists are modified in place
+        self._settings = copy.deepcopy(default_settings)
+        self._clear_cache()
+
+    def _clear_cache(self):
+        """
+        Forget the cached device properties.
+        """
+        self._hardware_info = None
+        self._num_channels = None
+        self._base_resolution = None
+        self._resolution = None
+
+    @property
+    def lock(self):
+        """
+        Get the device lock.
+        """
+        return self._api.lock
 
     @property
     def mode(self):
@@ -546,6 +687,9 @@ class TH260():
 
         Closes and releases the device for use by other programs.
         """
+        if self._records_executor is not None:
+            self._records_executor.shutdown()
+            self._records_executor = None
         self._api.closeDevice()
 
     def openDevice(self):
@@ -561,7 +705,6 @@ class TH260():
         elif self._serial != serial:
             raise RuntimeError('Incorrect serial.')
 
-    @dlllock
     def initialize(self, settings=None):
         """
         initialize the device with the settings.
@@ -575,11 +718,22 @@ class TH260():
         if settings is not None:
             for key in settings:
                 if key in self._settings:
-                    self._settings[key] = settings[key]
+                    self._settings[key] = copy.deepcopy(settings[key])
+
+        self._initialize_device()
 
+        # Wait outside of the lock so other callers are not blocked
+        time.sleep(thdef.INIT_WAIT_TIME)
+
+    @dlllock
+    def _initialize_device(self):
+        """
+        Initialize the device and apply the settings.
+        """
         mode = self._settings['mode']
         assert mode in [thdef.MODE_T2, thdef.MODE_T3]
         self._api.initialize(self._settings['mode'])
+        self._clear_cache()
 
         hardware_info = self.getHardwareInfo()
         numChannels = self.getNumOfInputChannels()
@@ -596,7 +750,8 @@ class TH260():
             if len(self._settings[key]) == 1:
                 self._settings[key] *= numChannels
 
-        self.setSyncDiv(self._settings['syncDivider'])
+        # initialize waits for valid count rates once the lock is released
+        self._api.setSyncDiv(self._settings['syncDivider'])
 
         if hardware_info['Model'] == "TimeHarp 260 P":
             self.setSyncCFD(
@@ -616,7 +771,7 @@ class TH260():
                 self._settings['syncTriggerEdge'])
             # we use the same input self._settings for all channels
             for i in range(numChannels):
-                self.SetInputEdgeTrg(
+                self.setInputEdgeTrg(
                     i,
                     self._settings['inputTriggerLevel'][i],
                     self._settings['inputTriggerEdge'][i])
@@ -630,13 +785,13 @@ class TH260():
         self.setBinning(self._settings['binning'])
         self.setOffset(self._settings['offset'])
 
-        time.sleep(thdef.INIT_WAIT_TIME)
-
     def getHardwareInfo(self):
         """
         Get Hardware Info.
         """
-        return self._api.getHardwareInfo()
+        if self._hardware_info is None:
+            self._hardware_info = self._api.getHardwareInfo()
+        return self._hardware_info
 
     def getNumOfInputChannels(self):
         """
@@ -647,7 +802,9 @@ class TH260():
         possible to connect a detector also to the sync channel, e.g. in
         histogramming mode for antibunching or in T2 mode.
         """
-        return self._api.getNumOfInputChannels()
+        if self._num_channels is None:
+            self._num_channels = self._api.getNumOfInputChannels()
+        return self._num_channels
 
     def setSyncDiv(self, syncDivider):
         """
@@ -662,6 +819,9 @@ class TH260():
         """
         self._settings['syncDivider'] = syncDivider
         self._api.setSyncDiv(syncDivider)
+        # Note: after Init or SetSyncDiv allow 150 ms
+        # for valid count rate readings
+        time.sleep(thdef.INIT_WAIT_TIME)
 
     def getSyncDiv(self):
         """
@@ -777,6 +937,7 @@ class TH260():
         """
         self._settings['binning'] = binning
         self._api.setBinning(binning)
+        self._resolution = None
 
     def getBinning(self):
         """
@@ -810,7 +971,9 @@ class TH260():
         This is meaningful only in histogramming and T3 mode. T2 mode always
         runs at the boards's base resolution.
         """
-        return self._api.getResolution()
+        if self._resolution is None:
+            self._resolution = self._api.getResolution()
+        return self._resolution
 
     def getBaseResolution(self):
         """
@@ -819,7 +982,9 @@ class TH260():
         The value returned in binsteps is the maximum value allowed for the
         TH260_SetBinning function.
         """
-        return self._api.getBaseResolution()
+        if self._base_resolution is None:
+            self._base_resolution = self._api.getBaseResolution()
+        return self._base_resolution
 
     def getSyncRate(self):
         """
@@ -865,7 +1030,18 @@ class TH260():
     def _fill_buffer(self):
         """
         Fill measurment buffer.
-        """
+
+        The buffers are stored by another thread so the next FIFO read can
+        start during the copy.
+        """
+        # At most fifo_ring_size - 2 buffers wait, so the one being stored
+        # and the one being read are never the same.
+        queue = Queue(maxsize=fifo_ring_size - 2)
+        store_thread = threading.Thread(
+            target=self._store_buffers, args=(queue,))
+        store_thread.start()
+        # Number of consecutive empty reads
+        empty_reads = 0
         # Empty local buffer
         try:
             while self.is_running():
@@ -873,19 +1049,49 @@ class TH260():
                 try:
                     buffer = self._api.readFiFo()
                 except TH260Error as e:
-                    if e.args[1] == "FiFo Overrun!":
-                        self.stop_measure(thdef.STOPREASON_FIFO_OVERRUN)
+                    if e.args[1] != "FiFo Overrun!":
+                        raise
+                    self.stop_measure(thdef.STOPREASON_FIFO_OVERRUN)
+                    continue
                 # Save Buffer
                 if len(buffer) > 0:
-                    self._local_buffer.append(buffer)
+                    queue.put(buffer)
+                    empty_reads = 0
                 else:
-                    # Check for timeover
-                    ctcstatus = self._api.CTCStatus()
-                    if ctcstatus > 0:
+                    # Check for timeover, the status was polled by readFiFo
+                    if self._api.pollStatus()[1] > 0:
                         self.stop_measure(thdef.STOPREASON_TIMEOVER)
                         return
+                    # Back off while the FIFO stays empty,
+                    # stop_measure interrupts the wait.
+                    empty_reads += 1
+                    if empty_reads >= 2:
+                        self._stop_event.wait(min(0.005, 1e-4 * empty_reads))
         except TH260Error:
             self.stop_measure(thdef.STOPREASON_ERROR)
+        finally:
+            queue.put(None)
+            store_thread.join()
+
+    def _store_buffers(self, queue):
+        """
+        Copy the buffers read from the FIFO into the local buffer.
+
+        On error the measurment is stopped, and the queue is still emptied
+        so the acquisition thread is not blocked.
+        """
+        while True:
+            buffer = queue.get()
+            if buffer is None:
+                return
+            if self._store_error is not None:
+                continue
+            try:
+                with self._local_buffer_lock:
+                    self._local_buffer.add(buffer)
+            except Exception as e:
+                self._store_error = e
+                self.stop_measure(thdef.STOPREASON_ERROR)
 
     def measure(self, time_acquisition=None, blocking=True,
                 bin_time=None, only_bin=False, keep_buffer=True,
@@ -893,6 +1099,8 @@ class TH260():
         """
         Start a measurment and generates the buffers.
         """
+        if fifo_ring_size < 3:
+            raise ValueError("fifo_ring_size must be at least 3.")
 
         if time_acquisition is None:
             time_acquisition = thdef.ACQTMAX
@@ -900,7 +1108,7 @@ class TH260():
         self._keep_buffer = keep_buffer
 
         # Reset buffers and records
-        self._local_buffer = []
+        self._local_buffer = ExtendableTable(dtype='uint32')
         if channels is None:
             channels = [1]
         if self.mode == 2:
@@ -913,9 +1121,11 @@ class TH260():
         else:
             raise NotImplementedError
         self._records_read_position = 0
+        self._records_read_time = time.monotonic()
 
-        self.__running = True
+        self._stop_event.clear()
         self._stop_reason = None
+        self._store_error = None
 
         self._api.startMeas(int(self._acquisition_time))
         self._measure_thread = threading.Thread(target=self._fill_buffer)
@@ -927,7 +1137,7 @@ class TH260():
         """
         Stop measurment.
         """
-        self.__running = False
+        self._stop_event.set()
         self._stop_reason = reason
         self._api.stopMeas()
 
@@ -935,14 +1145,22 @@ class TH260():
         """
         Check if measurment is running.
         """
-        return self.__running
+        return not self._stop_event.is_set()
 
     def wait_end_measure(self):
         """
         Wait for the end of measurment.
+
+        Raises the error that stopped the storing of the records, if any.
         """
-        if self.__running:
+        # Also join after a stop, the last buffers might still be stored
+        if self._measure_thread is not None:
             self._measure_thread.join()
+        # Raise the storing error here, as it happened in another thread
+        if self._store_error is not None:
+            error = self._store_error
+            self._store_error = None
+            raise error
 
     def get_metadata(self, ndata, extra_metadata=None):
         '''
@@ -1023,6 +1241,10 @@ class TH260():
     def get_records(self):
         """
         Get the records in a usable format.
+
+        During a measurment, new records are only processed once at least
+        records_batch_size of them are available, or records_batch_delay
+        after the last processing.
         """
         # If we don't have a valid read position, return last good record
 
@@ -1030,16 +1252,40 @@ class TH260():
         if self._records_read_position == buffer_len:
             return self._records
 
-        buffer_slice = slice(self._records_read_position, buffer_len)
-        buffer = np.concatenate(self._local_buffer[buffer_slice])
-        for channel in self._records:
-            self._records[channel].add_buffer(buffer)
+        # Wait for a full batch while measuring to amortize the processing
+        n_new = buffer_len - self._records_read_position
+        if (n_new < records_batch_size and self.is_running()
+                and time.monotonic() - self._records_read_time
+                < records_batch_delay):
+            return self._records
+        self._records_read_time = time.monotonic()
+
+        # View on the new records, the table only grows while we read it
+        buffer = self._local_buffer.data[
+            self._records_read_position:buffer_len]
+        records = list(self._records.values())
+        if len(records) > 1 and records_threads > 1:
+            # The channels are independent and numpy releases the GIL.
+            # The threads are kept for the next calls.
+            if self._records_executor is None:
+                self._records_executor = ThreadPoolExecutor(
+                    max_workers=records_threads)
+            futures = [self._records_executor.submit(record.add_buffer,
+                                                     buffer)
+                       for record in records]
+            for future in futures:
+                # Raise any exception here
+                future.result()
+        else:
+            for record in records:
+                record.add_buffer(buffer)
 
         # Empty buffer if needed
         if self._keep_buffer:
             self._records_read_position = buffer_len
         else:
-            del self._local_buffer[buffer_slice]
+            with self._local_buffer_lock:
+                self._local_buffer.remove(buffer_len)
             self._records_read_position = 0
 
         return self._records
@@ -1053,7 +1299,7 @@ class TH260():
         # Current data
         if len(self._local_buffer) == 0:
             raise RuntimeError('Nothing to save!')
-        data = np.concatenate(self._local_buffer)
+        data = self._local_buffer.data
         tags = self.get_metadata(len(data), metadata)
 
         write_ptu(outputfilename, data, tags)
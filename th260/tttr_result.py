@@ -7,6 +7,8 @@ Created on Wed Jul 24 13:46:53 2019
 
 @author: Quentin Peter
 """
+import sys
+import threading
 import numpy as np
 
 from th260.ptu_format import read_T2_buffer, read_T3_buffer
@@ -15,6 +17,65 @@ from th260.ptu_format import read_T2_buffer, read_T3_buffer
 T2WRAPAROUND_V2 = 0x2000000
 T3WRAPAROUND = 0x400
 
+# Maximum number of bytes kept to be reused by new tables
+table_pool_size = 0x4000000
+
+# Arrays of deleted tables by (dtype, row shape), reused to avoid page faults
+_table_pool = {}
+_table_pool_bytes = 0
+# Reentrant as a table can be deleted while the pool is used
+_table_pool_lock = threading.RLock()
+
+
+def _refcount(array):
+    """Number of references to array."""
+    return sys.getrefcount(array)
+
+
+class _RefcountProbe():
+    """Holds an array like a table does."""
+
+    def __init__(self):
+        self.data = np.empty(0)
+
+    def refcount(self):
+        """Number of references to the array, as counted in a table."""
+        return _refcount(self.data)
+
+
+# References to the array of a table when nothing else uses it
+_unused_refcount = _RefcountProbe().refcount()
+
+
+def _pop_pooled_array(shape, dtype):
+    """
+    Get a pooled array with between 1 and 4 times the rows of shape, or None.
+    """
+    global _table_pool_bytes
+    with _table_pool_lock:
+        arrays = _table_pool.get((np.dtype(dtype), shape[1:]), [])
+        best = None
+        for index, array in enumerate(arrays):
+            if (shape[0] <= len(array) <= 4 * shape[0]
+                    and (best is None or len(array) < len(arrays[best]))):
+                best = index
+        if best is None:
+            return None
+        array = arrays.pop(best)
+        _table_pool_bytes -= array.nbytes
+        return array
+
+
+def _pool_array(array):
+    """Keep array to be reused, if the pool is not full."""
+    global _table_pool_bytes
+    with _table_pool_lock:
+        if _table_pool_bytes + array.nbytes > table_pool_size:
+            return
+        _table_pool.setdefault((array.dtype, array.shape[1:]), []).append(
+            array)
+        _table_pool_bytes += array.nbytes
+
 
 class ExtendableTable():
     """Wrap around a numpy array for frequent append."""
@@ -28,6 +89,8 @@ class ExtendableTable():
         else:
             shape = (0x100, )
         self.__data = np.zeros(shape, dtype=dtype)
+        # The data is self.__data[self._head:self._size]
+        self._head = 0
         self._size = 0
         self._ndim = ndim
         self.dtype = dtype
@@ -36,46 +99,104 @@ class ExtendableTable():
         """
         Add list to table, growing it as needed.
         """
+        nrows = len(data)
+        self.reserve(nrows)
 
-        new_size = self._size + np.shape(data)[0]
-        self._inner_resize(new_size)
-
+        new_size = self._size + nrows
         self.__data[self._size:new_size] = data
         self._size = new_size
 
+    def grow(self, nrows):
+        """
+        Add nrows uninitialised rows and return them to be filled in place.
+        """
+        self.reserve(nrows)
+
+        new_size = self._size + nrows
+        rows = self.__data[self._size:new_size]
+        self._size = new_size
+        return rows
+
+    def reserve(self, nrows):
+        """
+        Make room for nrows more rows, so adding them doesn't reallocate.
+
+        Use it when the final size is known in advance.
+        """
+        self._inner_resize(self._size + nrows)
+
     def _inner_resize(self,  new_size):
         """
         New size for array.
         """
-        capacity = len(self.__data)
-        if new_size >= capacity:
-            new_capacity = 2 ** int(np.ceil(np.log2(new_size)))
-            if self._ndim is not None:
-                shape = (new_capacity, self._ndim)
-            else:
-                shape = (new_capacity, )
+        if new_size <= len(self.__data):
+            return
+        # Mostly removed rows, copy the data without them
+        compact = self._head > len(self.__data) // 2
+        if compact:
+            new_size -= self._head
+        shape = self._shape(new_size)
+
+        # Reuse the memory of a deleted table if possible
+        newdata = _pop_pooled_array(shape, self.dtype)
+        if newdata is None and not compact:
+            try:
+                # Uses realloc, which can extend the buffer in place or
+                # remap large buffers without copying
+                self.__data.resize(shape)
+                return
+            except ValueError:
+                # Views on the data exist and must stay valid, copy instead
+                pass
+        if newdata is None:
             newdata = np.empty(shape, dtype=self.dtype)
-            newdata[:self._size] = self.__data[:self._size]
-            self.__data = newdata
+
+        # The old array is not modified as views on it might still be read
+        size = self._size - self._head
+        newdata[:size] = self.__data[self._head:self._size]
+        self.__data = newdata
+        self._head = 0
+        self._size = size
+
+    def _shape(self, nrows):
+        """
+        Shape of an array with room for nrows rows.
+        """
+        # Next power of two
+        capacity = max(0x100, 1 << (int(nrows) - 1).bit_length())
+        if self._ndim is not None:
+            return (capacity, self._ndim)
+        return (capacity, )
+
+    def __del__(self):
+        """
+        Give the array to the pool, unless it is still used.
+        """
+        # Only grown arrays are worth keeping
+        if (len(self.__data) > 0x100
+                and _refcount(self.__data) <= _unused_refcount):
+            _pool_array(self.__data)
 
     def __len__(self):
         """
         Length of data.
         """
-        return self._size
+        return self._size - self._head
 
     @property
     def data(self):
         """
         Get the data.
         """
-        return self.__data[:self._size]
+        return self.__data[self._head:self._size]
 
     def remove(self, nremove):
         '''Remove from the data.'''
-        new_size = self._size - nremove
-        self.__data[:new_size] = self.__data[nremove:self._size]
-        self._size = new_size
+        # Only move the head, the rows are reused when growing
+        self._head += nremove
+        if self._head >= self._size:
+            self._head = 0
+            self._size = 0
 
 
 class binnableTable(ExtendableTable):
@@ -83,42 +204,93 @@ class binnableTable(ExtendableTable):
     def __init__(self, ndim=None, dtype='uint32',
                  bin_factor=None, only_bin=False):
         super().__init__(ndim=ndim, dtype=dtype)
-        self._bin_factor = bin_factor
+        self._set_bin_factor(bin_factor)
         self._bin_read_position = 0
-        self._bin_counts = np.zeros(0, dtype=int)
+        self._reset_bin_counts()
         self._only_bin = only_bin
 
+    def _set_bin_factor(self, bin_factor):
+        """Set the bin factor, and the equivalent shift if there is one."""
+        self._bin_factor = bin_factor
+        self._bin_shift = None
+        if bin_factor is not None and bin_factor == int(bin_factor):
+            bin_factor = int(bin_factor)
+            if bin_factor > 0 and bin_factor & (bin_factor - 1) == 0:
+                # Power of two, a shift is much faster than a division
+                self._bin_shift = bin_factor.bit_length() - 1
+
+    def _reset_bin_counts(self):
+        """Discard the bin counts."""
+        # Accumulator grown by doubling, the first _n_bins are valid
+        self._bin_counts = np.zeros(0x100, dtype=int)
+        self._n_bins = 0
+
     def bin_count(self):
-        """Get bin counts with factor given in set_bin_time."""
+        """
+        Get bin counts with factor given in set_bin_time.
+
+        Returns a copy, which is not changed by the next calls.
+        """
 
         if self._bin_factor is None:
             raise RuntimeError('Need to set bin factor.')
 
-        newpos = self._size
+        newpos = len(self)
         if newpos == self._bin_read_position:
-            return self._bin_counts
+            return self._bin_counts[:self._n_bins].copy()
 
-        timetags = self.data[self._bin_read_position:newpos]
-        timetags = timetags // self._bin_factor
+        self._add_bin_counts(self.data[self._bin_read_position:newpos])
 
-        bin_count = np.bincount(timetags)
-        bin_count[:len(self._bin_counts)] += self._bin_counts
-
-        self._bin_counts = bin_count
         if self._only_bin:
             self.remove(newpos)
             self._bin_read_position = 0
         else:
             self._bin_read_position = newpos
-        return bin_count
+        return self._bin_counts[:self._n_bins].copy()
+
+    def bin_data(self, data):
+        """
+        Add data to the bin counts without storing it.
+
+        Only possible with only_bin, where the data is discarded once binned.
+        """
+        if not self._only_bin:
+            raise RuntimeError('The data must be stored.')
+        if self._bin_factor is None:
+            raise RuntimeError('Need to set bin factor.')
+        if len(data) > 0:
+            self._add_bin_counts(data)
+
+    def _add_bin_counts(self, timetags):
+        """Add the counts of timetags to the bin counts."""
+        if self._bin_shift is not None:
+            timetags = timetags >> self._bin_shift
+        else:
+            timetags = timetags // self._bin_factor
+
+        # Only count the bins spanned by the new timetags, not all from 0
+        first_bin = int(timetags.min())
+        timetags -= first_bin
+        new_counts = np.bincount(timetags)
+        n_bins = first_bin + len(new_counts)
+        if n_bins > len(self._bin_counts):
+            bin_counts = np.zeros(1 << (n_bins - 1).bit_length(), dtype=int)
+            bin_counts[:self._n_bins] = self._bin_counts[:self._n_bins]
+            self._bin_counts = bin_counts
+        if self._n_bins == 0:
+            # Nothing counted yet, the accumulator is all zeros
+            self._bin_counts[first_bin:n_bins] = new_counts
+        else:
+            self._bin_counts[first_bin:n_bins] += new_counts
+        self._n_bins = max(self._n_bins, n_bins)
 
     def set_bin_factor(self, bin_factor):
         """Change the bin time and discards the saved values."""
         if self._only_bin:
             raise NotImplementedError("We don't have the raw data")
-        self._bin_factor = bin_factor
+        self._set_bin_factor(bin_factor)
         self._bin_read_position = 0
-        self._bin_counts = np.zeros(0, dtype=int)
+        self._reset_bin_counts()
 
 
 class T2Result():
@@ -130,6 +302,8 @@ class T2Result():
         self._channel = channel
         self._bin_time = bin_time
         self.global_resolution = global_resolution
+        # Seconds per controller unit
+        self._sec_scale = global_resolution * 1e-12
 
         if self._bin_time:
             bin_factor = int(1e12 * self._bin_time / self.global_resolution)
@@ -140,19 +314,45 @@ class T2Result():
         # (https://github.com/numpy/numpy/issues/823)
         self._timetags = binnableTable(
             dtype='int64', bin_factor=bin_factor, only_bin=only_bin)
+        # Only the bin counts are kept, no need to store the timetags
+        self._only_bin = only_bin and bin_factor is not None
         self._n_overflows = 0
+        # Reused by difftime_s
+        self._difftime_buf = np.empty(0)
 
     def add_buffer(self, buffer):
         """
         Batch read T2 buffer.
         """
-        n_overflows, timetag, total_overflows = (
-            read_T2_buffer(buffer, channel=self._channel, rtype='photon'))
+        self.add_buffers([buffer])
+
+    def add_buffers(self, buffers):
+        """
+        Batch read consecutive T2 buffers, growing the table only once.
+        """
+        decoded = []
+        total_overflows = self._n_overflows
+        for buffer in buffers:
+            n_overflows, timetag, total_overflows = (
+                read_T2_buffer(buffer, channel=self._channel, rtype='photon',
+                               initial_overflow=total_overflows))
+            decoded.append((n_overflows, timetag))
 
-        n_overflows = self._n_overflows + np.asarray(n_overflows, 'int64')
-        self._timetags.add(n_overflows * T2WRAPAROUND_V2 + timetag)
+        if self._only_bin:
+            for n_overflows, timetag in decoded:
+                timetags = np.multiply(n_overflows, T2WRAPAROUND_V2)
+                timetags += timetag
+                self._timetags.bin_data(timetags)
+        else:
+            self._timetags.reserve(
+                sum(len(timetag) for _, timetag in decoded))
+            for n_overflows, timetag in decoded:
+                # Compute directly in the table, without temporaries
+                timetags = self._timetags.grow(len(timetag))
+                np.multiply(n_overflows, T2WRAPAROUND_V2, out=timetags)
+                timetags += timetag
 
-        self._n_overflows += total_overflows
+        self._n_overflows = int(total_overflows)
 
     @property
     def timetags(self):
@@ -161,19 +361,33 @@ class T2Result():
         """
         return self._timetags.data
 
-    def time_s(self):
+    def time_s(self, out=None, dtype=np.float64):
         """
         Arrival time of the photon, in s
+
+        The result can be written in out, and computed as float32 with dtype.
         """
-        return self.timetags * (self.global_resolution * 1e-12)
+        return np.multiply(self.timetags, self._sec_scale,
+                           out=out, dtype=dtype)
 
     def difftime_s(self):
         """
         Time since the last photon, in s.
 
         Uses int to avoid floating point rounding errors.
+        The returned array is a view that is overwritten by the next calls.
         """
-        return np.diff(self.timetags) * (self.global_resolution * 1e-12)
+        timetags = self.timetags
+        n_diff = max(len(timetags) - 1, 0)
+        if n_diff > len(self._difftime_buf):
+            self._difftime_buf = np.empty(
+                max(0x100, 1 << (n_diff - 1).bit_length()))
+
+        difftimes = self._difftime_buf[:n_diff]
+        # The subtraction is done on the ints, only the result is float
+        np.subtract(timetags[1:], timetags[:-1], out=difftimes)
+        difftimes *= self._sec_scale
+        return difftimes
 
     def bin_count(self):
         """Get bin counts with factor given in set_bin_time."""
@@ -196,26 +410,55 @@ class T3Result():
         self.global_resolution = global_resolution
         self.resolution = resolution
         self._channel = channel
+        # Seconds per sync unit and per dtime unit
+        self._sync_scale = global_resolution * 1e-9
+        self._dtime_scale = resolution * 1e-12
 
         self._bin_time = bin_time
         bin_factor = int(1e9 * self._bin_time / self.global_resolution)
         self._nsyncs = binnableTable(
             dtype='int64', bin_factor=bin_factor, only_bin=only_bin)
+        # Only the bin counts are kept, no need to store the nsyncs
+        self._only_bin = only_bin
 
         self._dtimes = ExtendableTable(dtype='uint32')
+        self._n_overflows = 0
 
     def add_buffer(self, buffer):
         """
         Read T3 buffer.
         """
-        n_overflows, dtime, nsync, total_overflows = (
-            read_T3_buffer(buffer, channel=self._channel, rtype='photon'))
-
-        n_overflows = self._n_overflows + np.asarray(n_overflows, 'int64')
-        self._nsyncs.add(n_overflows * T3WRAPAROUND + nsync)
-        self._dtimes.add(dtime)
+        self.add_buffers([buffer])
+
+    def add_buffers(self, buffers):
+        """
+        Read consecutive T3 buffers, growing the tables only once.
+        """
+        decoded = []
+        total_overflows = self._n_overflows
+        for buffer in buffers:
+            n_overflows, dtime, nsync, total_overflows = (
+                read_T3_buffer(buffer, channel=self._channel, rtype='photon',
+                               initial_overflow=total_overflows))
+            decoded.append((n_overflows, dtime, nsync))
+
+        n_records = sum(len(nsync) for _, _, nsync in decoded)
+        if not self._only_bin:
+            self._nsyncs.reserve(n_records)
+        self._dtimes.reserve(n_records)
+        for n_overflows, dtime, nsync in decoded:
+            if self._only_bin:
+                nsyncs = np.multiply(n_overflows, T3WRAPAROUND)
+                nsyncs += nsync
+                self._nsyncs.bin_data(nsyncs)
+            else:
+                # Compute directly in the table, without temporaries
+                nsyncs = self._nsyncs.grow(len(nsync))
+                np.multiply(n_overflows, T3WRAPAROUND, out=nsyncs)
+                nsyncs += nsync
+            self._dtimes.add(dtime)
 
-        self._n_overflows += total_overflows
+        self._n_overflows = int(total_overflows)
 
     @property
     def nsyncs(self):
@@ -229,19 +472,25 @@ class T3Result():
         """
         Time in controller units since the last sync event.
         """
-        return self._dtimes
+        return self._dtimes.data
 
-    def sync_time_s(self):
+    def sync_time_s(self, out=None, dtype=np.float64):
         """
         Time in seconds of the last sync event, ns resolution.
+
+        The result can be written in out, and computed as float32 with dtype.
         """
-        return self.nsyncs * (self.global_resolution * 1e-9)
+        return np.multiply(self.nsyncs, self._sync_scale,
+                           out=out, dtype=dtype)
 
-    def dtime_s(self):
+    def dtime_s(self, out=None, dtype=np.float64):
         """
         Time in seconds since the last sync event, ps resolution.
+
+        The result can be written in out, and computed as float32 with dtype.
         """
-        return self.dtimes * (self.resolution * 1e-12)
+        return np.multiply(self.dtimes, self._dtime_scale,
+                           out=out, dtype=dtype)
 
     def bin_count(self):
         """Get bin counts with factor given in set_bin_time."""